@@ -1,11 +1,19 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, List, Any, Dict
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Optional, List, Any, Dict, AsyncIterator
 from dotenv import load_dotenv
 import os
 import re
-import json
+import hashlib
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+
+import orjson
+from cachetools import LFUCache, TTLCache
+
+from openai.types.responses import ResponseTextDeltaEvent
 
 # OpenAI Agents SDK imports (adjust names per installed SDK)
 from agents import (
@@ -15,11 +23,7 @@ from agents import (
     Runner,
     SQLiteSession,
     set_tracing_disabled,
-    input_guardrail,
-    RunContextWrapper,
-    GuardrailFunctionOutput,
     TResponseInputItem,
-    InputGuardrailTripwireTriggered
 )
 
 load_dotenv()
@@ -30,6 +34,7 @@ if not GEMINI_API_KEY:
     raise RuntimeError("GEMINI_API_KEY (or OPENAI_API_KEY) not set in environment")
 
 DB_PATH = os.getenv("CONVERSATIONS_DB_PATH", "conversations.db")
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "20"))
 
 # small logger
 logging.basicConfig(level=logging.INFO)
@@ -46,78 +51,136 @@ model = OpenAIChatCompletionsModel(
     openai_client=external_client,
 )
 
-class AgentInputGuardrailOUtput(BaseModel):
-    unsafe: bool
-    reason: str
-
-
-bank_input_guard_agent = Agent(
-    name = "Bank InputGuardrail Agent",
-    instructions= (
-    """Check if the user input is a valid Habib Bank complaint.
-        Also detect profanity or sensitive personal info."""
-    ),
-    model=model,
-    output_type=AgentInputGuardrailOUtput,
+# global bound on in-flight LLM calls so request bursts don't run into upstream rate limits
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_SEM = asyncio.Semaphore(LLM_CONCURRENCY)
+_llm_waiting = 0
+
+@asynccontextmanager
+async def llm_slot() -> AsyncIterator[None]:
+    """Hold one LLM_SEM slot. Logs the queue depth when callers have to wait."""
+    global _llm_waiting
+    if LLM_SEM.locked():
+        logger.info("LLM concurrency limit (%d) reached, %d call(s) queued", LLM_CONCURRENCY, _llm_waiting + 1)
+    _llm_waiting += 1
+    try:
+        await LLM_SEM.acquire()
+    finally:
+        _llm_waiting -= 1
+    try:
+        yield
+    finally:
+        LLM_SEM.release()
+
+async def run_agent(agent: Agent, input: str | list[TResponseInputItem], **kwargs: Any) -> Any:
+    """Runner.run, gated by LLM_SEM."""
+    async with llm_slot():
+        return await Runner.run(agent, input, **kwargs)
+
+# Agent prompts are fully static and sent as the first (system) message of every call,
+# so each request shares an identical prefix that provider-side prompt caching can reuse.
+
+# {services} and {domains} are filled in from AGENT_MAP, so adding a modal needs no prompt edit
+DOMAIN_GUARD_INSTRUCTIONS = (
+    """Classify the user input for a complaint desk serving: {services}.
+        Set domain to the service the message is a complaint or question about, one of: {domains}.
+        Short follow-up replies in an ongoing complaint that don't name a service on their own (answers to intake questions, 'yes', 'submit') get domain 'followup'.
+        Anything unrelated to these services gets domain 'other'.
+        Set unsafe to true for profanity or sensitive personal info, and explain the decision in reason."""
 )
 
-@input_guardrail
-async def bank_input_guard(ctx: RunContextWrapper[None], agent: Agent, input: str | list[TResponseInputItem]) -> GuardrailFunctionOutput:
-    result = await Runner.run(bank_input_guard_agent, input, context=ctx.context)
-
-    # Directly pass AI output to GuardrailFunctionOutput
-    return GuardrailFunctionOutput(
-        output_info=result.final_output,  # full AI output
-        tripwire_triggered=result.final_output.unsafe,  # AI decides unsafe
-    )
-
 # Agent instruction: (tweak for your UX)
-BankFixFlowAgent = Agent(
-    name="Bank FixFlow Agent",
-    instructions=(
+BANK_AGENT_INSTRUCTIONS = (
     "You are a specialized complaint-handling agent for Habib Bank, responsible for support and intake of customer issues. When user describes a problem, first try to provide a clear, actionable fix if it can be solved by steps (app login, PIN reset, blocking card, OTP issues, branch info). "
         "If you can give a reliable fix, do so and then ask: 'Do you want me to file an official complaint for this issue?' — do NOT produce a JSON complaint yet. "
         "If you cannot reliably solve the issue (fraud, ATM cash not dispensed, unauthorized deduction, loan dispute, staff misbehavior, unresolved backend issues), start complaint intake: ask only relevant questions, never guess values, and leave unknown fields null. "
         "Only when the user explicitly confirms 'submit' should you output EXACTLY ONE ```json``` block containing the complaint with fields: "
         "{'issue':'', 'branch_or_atm':null, 'date_time':null, 'amount':null, 'description':null, 'photos':[]}. auto deduct category and priority based on issue."
-    ),
-    model=model,
-    input_guardrails=[bank_input_guard],
 )
 
-hospital_input_guard_agent = Agent(
-    name = "Hospital InputGuardrail Agent",
-    instructions= (
-    """Check if the user input is a valid Indus Hospital complaint.
-        Also detect profanity or sensitive personal info."""
-    ),
-    model=model,
-    output_type=AgentInputGuardrailOUtput,
+HOSPITAL_AGENT_INSTRUCTIONS = (
+    "You are a hospital complaint Agent. "
+    "If issue is simple (appointment, billing, reports, app login) → give fix steps. "
+    "If serious (staff, treatment, negligence) → collect complaint info step by step: "
+    "patient name, department, reason, issue, date/time, description, category, photos. "
+    "Never guess, leave unknown as null. "
+    "Only when user says 'submit', output one ```json``` with these fields."
 )
 
-@input_guardrail
-async def hospital_input_guard(ctx: RunContextWrapper[None], agent: Agent, input: str | list[TResponseInputItem]) -> GuardrailFunctionOutput:
-    result = await Runner.run(hospital_input_guard_agent, input, context=ctx.context)
+class DomainGuardOut(BaseModel):
+    unsafe: bool
+    reason: str
+    domain: str
 
-    # Directly pass AI output to GuardrailFunctionOutput
-    return GuardrailFunctionOutput(
-        output_info=result.final_output,  # full AI output
-        tripwire_triggered=result.final_output.unsafe,  # AI decides unsafe
-    )
 
+# guardrail verdicts cached in-process so repeated messages skip the classifier LLM call
+GUARD_CACHE: LFUCache = LFUCache(maxsize=10_000)
+# in-flight classifier calls, so concurrent identical inputs share a single LLM call
+_GUARD_INFLIGHT: Dict[str, asyncio.Task] = {}
+
+def cache_key(s: str) -> str:
+    """Short digest of s, used as an in-memory cache key."""
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+def guard_cache_key(message: str) -> str:
+    """Hash the normalized user message into a cache key."""
+    return cache_key(" ".join(message.lower().split()))
+
+async def _classify(key: str, message: str) -> DomainGuardOut:
+    result = await run_agent(domain_guard_agent, message)
+    GUARD_CACHE[key] = result.final_output
+    return result.final_output
+
+async def cached_guard_verdict(message: str) -> DomainGuardOut:
+    """Return the domain guard's verdict for message, calling the LLM only on a cache miss.
+
+    The verdict doesn't depend on the modal, so one cached entry serves every service.
+    """
+    key = guard_cache_key(message)
+    verdict = GUARD_CACHE.get(key)
+    if verdict is not None:
+        return verdict
+
+    # single-flight: join an identical call already in progress instead of starting another.
+    # there is no await between the lookup and the insert, so this is race-free on the event loop
+    task = _GUARD_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(_classify(key, message))
+        _GUARD_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _GUARD_INFLIGHT.pop(key, None))
+        # every waiter may have been cancelled by the time a failure lands
+        task.add_done_callback(_consume_result)
+
+    # shielded so one caller being cancelled doesn't cancel the call others are waiting on
+    return await asyncio.shield(task)
+
+def guard_rejects(verdict: DomainGuardOut, modal: str, has_history: bool) -> bool:
+    """True if the message is unsafe or belongs to a different service than modal.
+
+    A 'followup' is only accepted when there is a conversation for it to follow.
+    """
+    allowed = (modal, "followup") if has_history else (modal,)
+    return verdict.unsafe or verdict.domain.lower() not in allowed
+
+# first-turn answers (reply text, turn items) for FAQ-style openers; only a fresh session's
+# first turn is cached, since later replies depend on the conversation so far
+ANSWER_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=1800)
+
+def answer_cache_key(modal: str, message: str) -> str:
+    """Hash modal and normalized message into an ANSWER_CACHE key."""
+    return cache_key(f"{modal}|{' '.join(message.lower().split())}")
+
+
+BankFixFlowAgent = Agent(
+    name="Bank FixFlow Agent",
+    instructions=BANK_AGENT_INSTRUCTIONS,
+    model=model,
+)
 
 HospitalFixFlowAgent = Agent(
     name="HospitalFixFlowAgent",
-    instructions=(
-        "You are a hospital complaint Agent. "
-        "If issue is simple (appointment, billing, reports, app login) → give fix steps. "
-        "If serious (staff, treatment, negligence) → collect complaint info step by step: "
-        "patient name, department, reason, issue, date/time, description, category, photos. "
-        "Never guess, leave unknown as null. "
-        "Only when user says 'submit', output one ```json``` with these fields."
-    ),
+    instructions=HOSPITAL_AGENT_INSTRUCTIONS,
     model=model,
-    input_guardrails=[hospital_input_guard]
 )
 
 AGENT_MAP = {
@@ -125,6 +188,27 @@ AGENT_MAP = {
     "hospital": HospitalFixFlowAgent,
 }
 
+# map agent to friendly label
+FRIENDLY_LABELS: Dict[str, str] = {
+    "bank": "Habib Bank",
+    "hospital": "Indus Hospital",
+    # future agents
+    "school": "Beaconhouse School",
+    "telecom": "Jazz Telecom",
+    "airline": "PIA Airlines",
+}
+
+# single classifier for every modal, run by agent_message alongside the main agent
+domain_guard_agent = Agent(
+    name = "Domain InputGuardrail Agent",
+    instructions=DOMAIN_GUARD_INSTRUCTIONS.format(
+        services=", ".join(f"{FRIENDLY_LABELS[m]} ({m})" for m in AGENT_MAP),
+        domains=", ".join(f"'{m}'" for m in AGENT_MAP),
+    ),
+    model=model,
+    output_type=DomainGuardOut,
+)
+
 # MainRouterAgent = Agent(
 #     name="MainAgent",
 #     instructions=(
@@ -136,26 +220,45 @@ AGENT_MAP = {
 # )
 
 # helper functions
+# replies longer than this are parsed in a worker thread; below it the thread hop costs more than the parse
+PARSE_OFFLOAD_CHARS = 100_000
+
+_JSON_FENCE_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL)
+
 def parse_json_code_fence(text: str) -> Optional[Dict[str, Any]]:
     """Extract a single JSON object from a ```json { ... } ``` code fence in text."""
-    m = re.search(r"```json\s*(\{.*?\})\s*```", text, re.DOTALL)
+    # most replies carry no fence at all; skip the regex entirely for those
+    start = text.find("```json")
+    if start < 0:
+        return None
+    m = _JSON_FENCE_RE.search(text, start)
     if not m:
         return None
     try:
-        return json.loads(m.group(1))
+        return orjson.loads(m.group(1))
     except Exception as e:
         logger.warning("Failed to parse JSON code fence: %s", e)
         return None
 
 
 
+async def get_session(session_id: str) -> SQLiteSession:
+    """Create the per-request SQLiteSession for session_id off the event loop."""
+    # the constructor opens the DB file and creates tables. Instances are not kept
+    # across requests: each holds one connection per worker thread until it is collected
+    return await asyncio.to_thread(SQLiteSession, session_id, DB_PATH)
+
+
 # FastAPI app
-app = FastAPI(title="FixFlow Agent API")
+app = FastAPI(title="FixFlow Agent API", default_response_class=ORJSONResponse)
 
 class MessageIn(BaseModel):
     session_id: str
     modal_name:str
     message: str
+    # transcript is opt-in; when requested only the last transcript_limit items are returned
+    include_transcript: bool = False
+    transcript_limit: int = Field(default=50, ge=1)
 
 class AgentResponse(BaseModel):
     reply: str
@@ -163,65 +266,110 @@ class AgentResponse(BaseModel):
     final_complaint: Optional[Dict[str, Any]] = None
     transcript: Optional[List[Dict[str, Any]]] = None
 
+def off_topic_reply(modal: str) -> AgentResponse:
+    """Friendly reply returned when the input guardrail rejects a message."""
+    agent_label = FRIENDLY_LABELS.get(modal, modal.capitalize())
+
+    reply = (
+        f"I am here to assist with {agent_label} complaints only. "
+        f"If your issue is related to {agent_label}, I can file the complaint for you. "
+        )
+
+    return AgentResponse(
+        reply=reply,
+        is_final=False,
+        final_complaint=None,
+        transcript=[]
+    )
+
+def _consume_result(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        task.exception()
+
+def discard_task(task: asyncio.Task) -> None:
+    """Cancel task if still running, and make sure an error it ends with is never left unretrieved."""
+    if not task.done():
+        task.cancel()
+    task.add_done_callback(_consume_result)
+
+def pick_agent(modal_name: str) -> tuple[str, Agent]:
+    """Resolve modal_name to (modal, target agent), or raise a 400."""
+    modal = modal_name.lower()
+    target_agent = AGENT_MAP.get(modal)
+    if not target_agent:
+        raise HTTPException(status_code=400, detail=f"Service not found. Unknown modal_name: {modal_name}. Available services: {', '.join(AGENT_MAP)}.")
+    return modal, target_agent
+
+async def parse_final_complaint(output_text: str) -> Optional[Dict[str, Any]]:
+    """parse_json_code_fence, moved to a worker thread for very long replies."""
+    if len(output_text) > PARSE_OFFLOAD_CHARS:
+        return await asyncio.to_thread(parse_json_code_fence, output_text)
+    return parse_json_code_fence(output_text)
+
 @app.post("/agent/message", response_model=AgentResponse)
 async def agent_message(payload: MessageIn):
-    """Send a user message to the agent. Returns agent reply and session transcript."""
-    session_db_path = DB_PATH
+    """Send a user message to the agent. Returns agent reply and, if requested, the session transcript."""
     session_id = payload.session_id
 
     # create a per-session SQLiteSession (persistent file)
-    session = SQLiteSession(session_id, session_db_path)
+    session = await get_session(session_id)
 
     # Pick agent from modal_name
-    target_agent = AGENT_MAP.get(payload.modal_name.lower())
-    if not target_agent:
-        raise HTTPException(status_code=400, detail=f"Service not found. Unknown modal_name: {payload.modal_name}. Available services: bank, hospital.")
-    
+    modal, target_agent = pick_agent(payload.modal_name)
+
     # normal intake flow
-    logger.info("Running FixFlowAgent for session %s", session_id, target_agent.name)
+    logger.info("Running %s for session %s", target_agent.name, session_id)
     try:
-        result = await Runner.run(target_agent, input=payload.message, session=session)
-    
-    except InputGuardrailTripwireTriggered:
-    # map agent to friendly label
-        friendly_labels = {
-            "bank": "Habib Bank",
-            "hospital": "Indus Hospital",
-            # future agents
-            "school": "Beaconhouse School",
-            "telecom": "Jazz Telecom",
-            "airline": "PIA Airlines"
-        }
-
-        agent_label = friendly_labels.get(payload.modal_name.lower(), payload.modal_name.capitalize())
-
-        reply = (
-            f"I am here to assist with {agent_label} complaints only. "
-            f"If your issue is related to {agent_label}, I can file the complaint for you. "
-            )
-        
-        return AgentResponse(
-        reply=reply,
-        is_final=False,
-        final_complaint=None,
-        transcript=[]
-    )
+        history = await session.get_items()
+        answer_key = None if history else answer_cache_key(modal, payload.message)
+        cached = ANSWER_CACHE.get(answer_key) if answer_key else None
+
+        if cached is not None:
+            # only messages that passed the guardrail were cached, so replay the turn. The key is
+            # normalized, so swap in this user's own wording for the stored user message
+            output_text, cached_items = cached
+            items = [
+                {"role": "user", "content": payload.message} if item.get("role") == "user" else item
+                for item in cached_items
+            ]
+            await asyncio.shield(session.add_items(items))
+        else:
+            run_input = history + [{"role": "user", "content": payload.message}]
+
+            # run the guardrail and the main agent concurrently; the main run is speculative
+            # and works on a copy of the history, so nothing reaches the session until the
+            # guardrail has passed
+            guard_task = asyncio.create_task(cached_guard_verdict(payload.message))
+            main_task = asyncio.create_task(run_agent(target_agent, run_input))
+            try:
+                verdict = await guard_task
+                if guard_rejects(verdict, modal, bool(history)):
+                    return off_topic_reply(modal)
+                result = await main_task
+            finally:
+                for task in (guard_task, main_task):
+                    discard_task(task)
+
+            # persist only the new turn; shielded so a client disconnect can't leave it half-written
+            items = result.to_input_list()
+            await asyncio.shield(session.add_items(items[len(history):]))
+            output_text = result.final_output or ""
 
     except Exception as e:
         logger.exception("Agent run failed")
         raise HTTPException(status_code=500, detail=str(e))
 
-    output_text = result.final_output or ""
-
     # attempt to parse final JSON if agent emitted it
-    final_json = parse_json_code_fence(output_text)
+    final_json = await parse_final_complaint(output_text)
     is_final = final_json is not None
 
-    # get transcript (list of stored messages)
-    try:
-        transcript = await session.get_items()
-    except Exception:
-        transcript = None
+    # a submitted complaint must never be replayed to another session
+    if answer_key and cached is None and not is_final:
+        ANSWER_CACHE[answer_key] = (output_text, items)
+
+    # items already holds history + this turn, exactly what the session now stores,
+    # so the transcript needs no second read
+    transcript = items[-payload.transcript_limit:] if payload.include_transcript else None
 
     return AgentResponse(
         reply=output_text,
@@ -230,6 +378,125 @@ async def agent_message(payload: MessageIn):
         transcript=transcript,
     )
 
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one server-sent event with a JSON payload."""
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/agent/message/stream")
+async def agent_message_stream(payload: MessageIn):
+    """Like /agent/message, but streams the reply as server-sent events.
+
+    Emits `delta` events with text chunks as they are generated, then one `final` event
+    carrying the AgentResponse (complaint JSON included) once the turn is stored.
+    Failures after the stream has started are reported as an `error` event.
+    """
+    session = await get_session(payload.session_id)
+    modal, target_agent = pick_agent(payload.modal_name)
+
+    history = await session.get_items()
+    run_input = history + [{"role": "user", "content": payload.message}]
+
+    async def events() -> AsyncIterator[bytes]:
+        # same speculative scheme as agent_message: the agent starts generating while the
+        # guardrail runs, and deltas are only released once the guardrail has passed
+        deltas: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+        async def pump():
+            try:
+                async with llm_slot():
+                    result = Runner.run_streamed(target_agent, run_input)
+                    try:
+                        async for event in result.stream_events():
+                            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                                deltas.put_nowait(event.data.delta)
+                    finally:
+                        if not result.is_complete:
+                            result.cancel()
+                return result
+            finally:
+                deltas.put_nowait(None)
+
+        guard_task = asyncio.create_task(cached_guard_verdict(payload.message))
+        main_task = asyncio.create_task(pump())
+        try:
+            verdict = await guard_task
+            if guard_rejects(verdict, modal, bool(history)):
+                yield sse_event("final", off_topic_reply(modal).model_dump())
+                return
+
+            while (delta := await deltas.get()) is not None:
+                yield sse_event("delta", {"delta": delta})
+            result = await main_task
+
+            items = result.to_input_list()
+            await asyncio.shield(session.add_items(items[len(history):]))
+
+            output_text = result.final_output or ""
+            final_json = await parse_final_complaint(output_text)
+            yield sse_event("final", AgentResponse(
+                reply=output_text,
+                is_final=final_json is not None,
+                final_complaint=final_json,
+                transcript=items[-payload.transcript_limit:] if payload.include_transcript else None,
+            ).model_dump())
+
+        except Exception as e:
+            logger.exception("Agent stream failed")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            for task in (guard_task, main_task):
+                discard_task(task)
+
+    logger.info("Streaming %s for session %s", target_agent.name, payload.session_id)
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+class BatchItemOut(BaseModel):
+    ok: bool
+    response: Optional[AgentResponse] = None
+    error: Optional[str] = None
+
+@app.post("/agent/batch", response_model=List[BatchItemOut])
+async def agent_batch(payloads: List[MessageIn]):
+    """Send several messages at once. Each is handled like /agent/message; LLM_SEM bounds the fan-out.
+
+    Results come back per item in request order, so one failed message doesn't hide the others.
+    Messages sharing a session_id run one after another, so each turn sees the previous one.
+    """
+    if len(payloads) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch too large: {len(payloads)} messages, at most {BATCH_MAX_SIZE} allowed.")
+    # reject unknown services before any message is dispatched, not after some turns were stored
+    for payload in payloads:
+        pick_agent(payload.modal_name)
+
+    by_session: Dict[str, List[int]] = {}
+    for i, payload in enumerate(payloads):
+        by_session.setdefault(payload.session_id, []).append(i)
+    results: List[Optional[BatchItemOut]] = [None] * len(payloads)
+
+    async def run_session(indices: List[int]) -> None:
+        for i in indices:
+            try:
+                results[i] = BatchItemOut(ok=True, response=await agent_message(payloads[i]))
+            except HTTPException as e:
+                results[i] = BatchItemOut(ok=False, error=str(e.detail))
+            except Exception as e:
+                logger.exception("Batch item failed")
+                results[i] = BatchItemOut(ok=False, error=str(e))
+
+    await asyncio.gather(*[run_session(indices) for indices in by_session.values()])
+    return results
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("fixflow_agent_fastapi:app", host="0.0.0.0", port=8000, reload=True)
+    # uvicorn's "auto" loop/http pick uvloop and httptools (from uvicorn[standard]) where the
+    # platform has them. LLM_SEM and the caches live in each process, so extra workers
+    # (WEB_CONCURRENCY) multiply the upstream LLM bound and split the caches; default to one.
+    # set UVICORN_RELOAD=1 for local development
+    reload = os.getenv("UVICORN_RELOAD") == "1"
+    uvicorn.run(
+        "fixflow_agent_fastapi:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=1 if reload else int(os.getenv("WEB_CONCURRENCY", "1")),
+        reload=reload,
+    )